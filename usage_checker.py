@@ -3,30 +3,112 @@
 Codex CLI 用量查询模块
 """
 
+import base64
+import functools
+import heapq
+import itertools
 import json
 import os
-import glob
-from datetime import datetime, timedelta
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from pathlib import Path
-from typing import Dict, Optional
+from typing import Dict, Optional, Tuple
 from config_utils import get_config_paths
 
+# 可选依赖：安装了 orjson 时用它解析 session JSONL，否则回退到标准库
+try:
+    import orjson
+    _loads = orjson.loads
+    _JSON_ERRS = (orjson.JSONDecodeError, json.JSONDecodeError, UnicodeDecodeError)
+except ImportError:
+    _loads = json.loads
+    _JSON_ERRS = (json.JSONDecodeError, UnicodeDecodeError)
+
+
+# 查询失败时的输出模板：(标题, 错误列表)
+_FAILED_SUMMARY_TEMPLATE = (
+    "%s\n"
+    "❌ 查询失败:%s\n"
+    "\n💡 提示:\n"
+    "  - 请确保已经使用过 Codex CLI\n"
+    "  - 尝试运行 'codex' 命令并发送一条消息"
+)
+
+# 进程内不变的路径，只在导入时计算一次
+_HOME = Path.home()
+_CODEX_SESSIONS_DIR = _HOME / ".codex" / "sessions"
+
+# 用量缓存的内存层，进程内所有检查器实例共享（调用方通常每次请求都新建实例）：
+# 缓存文件路径 -> (缓存文件 mtime_ns, 写入时间戳, usage_data)
+_USAGE_MEM_CACHE = {}
+
+# 邮箱转安全文件名的替换规则（顺序与旧缓存文件名保持一致）
+_EMAIL_SUBS = (('@', '_at_'), ('.', '_'), ('+', '_plus_'))
+
+
+@functools.lru_cache(maxsize=256)
+def _safe_email(email: str) -> str:
+    """将邮箱转换为可用作缓存文件名的字符串"""
+    for old, new in _EMAIL_SUBS:
+        email = email.replace(old, new)
+    return email
+
+
+def _copy_usage_data(usage_data):
+    """浅拷贝内存缓存中的用量数据，避免调用方修改返回值污染缓存"""
+    return dict(usage_data) if isinstance(usage_data, dict) else usage_data
+
+
+def _iter_lines_reverse(path, block: int = 65536):
+    """按固定大小分块从文件末尾向前读取，逐行产出（bytes，已去除空行）"""
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        # 尚未遇到换行的行尾片段，按读取顺序保存（越靠后的片段在文件中越靠前），
+        # 整行读完时才拼接一次，避免超长行每读一块就复制一遍
+        pieces = []
+        while pos > 0:
+            read_size = min(block, pos)
+            pos -= read_size
+            f.seek(pos)
+            lines = f.read(read_size).split(b'\n')
+            if len(lines) == 1:
+                pieces.append(lines[0])
+                continue
+            pieces.append(lines[-1])
+            line = b''.join(reversed(pieces)).strip()
+            if line:
+                yield line
+            for line in reversed(lines[1:-1]):
+                line = line.strip()
+                if line:
+                    yield line
+            # 第一段可能是不完整的行，留到下一轮拼接
+            pieces = [lines[0]]
+        line = b''.join(reversed(pieces)).strip()
+        if line:
+            yield line
+
 
 class CodexUsageChecker:
     """Codex CLI 用量检查器"""
     
     def __init__(self, usage_cache_dir=None):
         """初始化用量检查器"""
-        self.codex_sessions_dir = Path.home() / ".codex" / "sessions"
+        self.codex_sessions_dir = _CODEX_SESSIONS_DIR
         
         # 用量缓存目录
         if usage_cache_dir:
             self.usage_cache_dir = Path(usage_cache_dir)
         else:
-            # 与 Tauri 端一致：appConfigDir()/codex-config/usage_cache
-            self.usage_cache_dir = get_config_paths()['usage_cache_dir']
+            self.usage_cache_dir = self._default_usage_cache_dir()
+        
+        # 缓存目录在首次写入时才创建
+        self._cache_dir_ready = False
         
-        self.usage_cache_dir.mkdir(parents=True, exist_ok=True)
+        # 邮箱 -> 用量缓存文件路径
+        self._cache_file_paths = {}
         
         # 缓存有效期（小时），默认30天，可通过环境变量覆盖
         # 例如：export CODEX_USAGE_CACHE_TTL_HOURS=168  # 7天
@@ -35,108 +117,205 @@ class CodexUsageChecker:
         except ValueError:
             self.cache_ttl_hours = 720
     
-    def find_latest_session_file(self) -> Optional[Path]:
-        """查找最新的有用量数据的 session 文件"""
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def _default_usage_cache_dir() -> Path:
+        """默认用量缓存目录，与 Tauri 端一致：appConfigDir()/codex-config/usage_cache"""
+        return get_config_paths()['usage_cache_dir']
+    
+    def find_latest_session_file(self) -> Optional[Tuple[Path, Optional[Dict]]]:
+        """查找最新的有用量数据的 session 文件，返回 (文件路径, 最新 token_count 事件)"""
         if not self.codex_sessions_dir.exists():
             return None
         
-        pattern = str(self.codex_sessions_dir / "**" / "rollout-*.jsonl")
-        session_files = glob.glob(pattern, recursive=True)
-        
-        if not session_files:
+        candidates = list(self._walk_session_files(str(self.codex_sessions_dir)))
+        if not candidates:
             return None
         
-        # 按修改时间排序，检查最近的文件
-        session_files.sort(key=lambda x: Path(x).stat().st_mtime, reverse=True)
+        # 按修改时间取最近的10个文件，无需对全部文件排序
+        latest = heapq.nlargest(10, candidates)
         
-        for session_file in session_files[:10]:  # 只检查最近10个文件
-            if self._has_token_count_data(Path(session_file)):
-                return Path(session_file)
+        # (mtime, path) 已在遍历时一次性收集，这里只为候选文件构造一次 Path
+        session_files = [Path(session_file) for _, session_file in latest]
+        hit = self._probe_candidates(session_files)
+        if hit:
+            return hit
         
-        return Path(session_files[0]) if session_files else None
+        newest = session_files[0]
+        return newest, self._find_latest_token_count(newest)
     
-    def _has_token_count_data(self, session_file: Path) -> bool:
-        """检查 session 文件是否包含 token_count 数据"""
+    def _probe_candidates(self, session_files) -> Optional[Tuple[Path, Dict]]:
+        """按 mtime 从新到旧检查候选文件末尾的20行，返回最新的命中结果
+        
+        读取是 I/O 密集的（例如 NFS 上的共享 home），候选较多时并发探测。
+        """
+        if len(session_files) <= 2:
+            for session_file in session_files:
+                token_data = self._find_latest_token_count(session_file, max_lines=20)
+                if token_data:
+                    return session_file, token_data
+            return None
+        
+        with ThreadPoolExecutor(max_workers=min(4, len(session_files))) as executor:
+            futures = [
+                executor.submit(self._find_latest_token_count, session_file, 20)
+                for session_file in session_files
+            ]
+            # 按提交顺序（即 mtime 从新到旧）取结果，保证返回最新的命中而非最先完成的
+            for index, future in enumerate(futures):
+                token_data = future.result()
+                if token_data:
+                    for pending in futures[index + 1:]:
+                        pending.cancel()
+                    return session_files[index], token_data
+        return None
+    
+    def _walk_session_files(self, directory: str):
+        """递归遍历 sessions 目录，产出 (mtime, path) 元组"""
         try:
-            with open(session_file, 'r', encoding='utf-8') as f:
-                # 只读取最后几行来快速检查
-                lines = f.readlines()
-                for line in reversed(lines[-20:]):  # 检查最后20行
+            with os.scandir(directory) as it:
+                for entry in it:
                     try:
-                        data = json.loads(line.strip())
-                        if data.get('payload', {}).get('type') == 'token_count':
-                            return True
-                    except json.JSONDecodeError:
+                        if entry.is_dir(follow_symlinks=False):
+                            yield from self._walk_session_files(entry.path)
+                        elif entry.name.startswith('rollout-') and entry.name.endswith('.jsonl'):
+                            yield (entry.stat().st_mtime, entry.path)
+                    except OSError:
                         continue
-            return False
-        except (OSError, IOError):
-            return False
+        except OSError:
+            return
     
-    def parse_session_file(self, session_file: Path) -> Optional[Dict]:
-        """解析 session 文件，查找最新的 token_count 事件"""
+    def _find_latest_token_count(self, session_file: Path, max_lines: Optional[int] = None) -> Optional[Dict]:
+        """从文件末尾向前查找最新的 token_count 事件，max_lines 限制检查的行数"""
         try:
-            with open(session_file, 'r', encoding='utf-8') as f:
-                lines = f.readlines()
-            
-            # 从后往前查找最新的 token_count 事件
-            for line in reversed(lines):
+            # islice 直接截断迭代器，不必每行比较计数；max_lines 为 None 时不限制
+            for line in itertools.islice(_iter_lines_reverse(session_file), max_lines):
+                # 先做子串预筛，只有可能是 token_count 事件的行才完整解析 JSON。
+                # 只匹配带引号的值本身，不依赖 Codex CLI 输出中 "type":"..." 的空白格式
+                if b'"token_count"' not in line:
+                    continue
                 try:
-                    data = json.loads(line.strip())
+                    data = _loads(line)
                     payload = data.get('payload', {})
                     
                     if payload.get('type') == 'token_count' and 'rate_limits' in payload:
                         return data
-                except json.JSONDecodeError:
+                except _JSON_ERRS:
                     continue
             
             return None
         except (OSError, IOError):
             return None
     
+    def _has_token_count_data(self, session_file: Path) -> bool:
+        """检查 session 文件是否包含 token_count 数据"""
+        try:
+            # 只检查文件末尾的20行
+            for line in itertools.islice(_iter_lines_reverse(session_file), 20):
+                if b'"token_count"' not in line:
+                    continue
+                try:
+                    if _loads(line).get('payload', {}).get('type') == 'token_count':
+                        return True
+                except _JSON_ERRS:
+                    continue
+            return False
+        except (OSError, IOError):
+            return False
+    
+    def parse_session_file(self, session_file: Path) -> Optional[Dict]:
+        """解析 session 文件，查找最新的 token_count 事件（兼容性方法）"""
+        return self._find_latest_token_count(session_file)
+    
+    def _usage_cache_file(self, email: str) -> Path:
+        """获取邮箱对应的用量缓存文件路径"""
+        cache_file = self._cache_file_paths.get(email)
+        if cache_file is None:
+            cache_file = self.usage_cache_dir / f"{_safe_email(email)}_usage.json"
+            self._cache_file_paths[email] = cache_file
+        return cache_file
+    
     def save_usage_data(self, email: str, usage_data: Dict) -> bool:
         """保存用量数据到缓存"""
         if not email:
             return False
         
         try:
-            safe_email = email.replace('@', '_at_').replace('.', '_').replace('+', '_plus_')
-            cache_file = self.usage_cache_dir / f"{safe_email}_usage.json"
+            cache_file = self._usage_cache_file(email)
             
             cache_data = {
                 "email": email,
                 "last_updated": datetime.now().isoformat(),
+                "last_updated_epoch": time.time(),
                 "usage_data": usage_data
             }
             
-            with open(cache_file, 'w', encoding='utf-8') as f:
-                json.dump(cache_data, f, indent=2, ensure_ascii=False)
+            _USAGE_MEM_CACHE.pop(str(cache_file), None)
+            
+            if not self._cache_dir_ready:
+                self.usage_cache_dir.mkdir(parents=True, exist_ok=True)
+                self._cache_dir_ready = True
+            
+            # 先写临时文件再原子替换，读取方不会看到写了一半的缓存
+            tmp_file = cache_file.with_suffix(cache_file.suffix + '.tmp')
+            try:
+                with open(tmp_file, 'w', encoding='utf-8') as f:
+                    json.dump(cache_data, f, indent=2, ensure_ascii=False)
+                os.replace(tmp_file, cache_file)
+            except (OSError, IOError):
+                try:
+                    tmp_file.unlink()
+                except OSError:
+                    pass
+                raise
             
             return True
         except (OSError, IOError):
             return False
     
     def load_usage_data(self, email: str) -> Optional[Dict]:
-        """从缓存加载用量数据"""
+        """从缓存加载用量数据，返回的是副本，调用方可以随意修改"""
         if not email:
             return None
         
         try:
-            safe_email = email.replace('@', '_at_').replace('.', '_').replace('+', '_plus_')
-            cache_filename = f"{safe_email}_usage.json"
-            cache_file = self.usage_cache_dir / cache_filename
+            cache_file = self._usage_cache_file(email)
             
-            if not cache_file.exists():
+            # 缓存文件每次都是整体重写，先用 mtime 判断是否过期，过期文件无需读取解析
+            ttl_seconds = self.cache_ttl_hours * 3600
+            now = time.time()
+            try:
+                stat = cache_file.stat()
+            except OSError:
                 return None
+            if now - stat.st_mtime > ttl_seconds:
+                return None
+            
+            # 文件未被重写时直接返回内存中的结果
+            mem_key = str(cache_file)
+            cached = _USAGE_MEM_CACHE.get(mem_key)
+            if cached and cached[0] == stat.st_mtime_ns:
+                if now - cached[1] > ttl_seconds:
+                    return None
+                return _copy_usage_data(cached[2])
             
             with open(cache_file, 'r', encoding='utf-8') as f:
                 cache_data = json.load(f)
             
             # 检查数据是否过期（超过配置的TTL，默认30天）
-            last_updated = datetime.fromisoformat(cache_data.get('last_updated', ''))
-            if datetime.now() - last_updated > timedelta(hours=self.cache_ttl_hours):
+            # 旧版本写入的缓存没有 last_updated_epoch（或值无效），回退到解析 ISO 时间
+            epoch = cache_data.get('last_updated_epoch')
+            if not isinstance(epoch, (int, float)) or isinstance(epoch, bool):
+                epoch = datetime.fromisoformat(cache_data.get('last_updated', '')).timestamp()
+            if now - epoch > ttl_seconds:
                 return None
             
-            return cache_data.get('usage_data')
+            usage_data = cache_data.get('usage_data')
+            if len(_USAGE_MEM_CACHE) >= 64:
+                # 简单的 FIFO 淘汰，避免无限增长
+                _USAGE_MEM_CACHE.pop(next(iter(_USAGE_MEM_CACHE)))
+            _USAGE_MEM_CACHE[mem_key] = (stat.st_mtime_ns, epoch, usage_data)
+            return _copy_usage_data(usage_data)
         except (OSError, IOError, json.JSONDecodeError, ValueError):
             return None
     
@@ -150,13 +329,13 @@ class CodexUsageChecker:
             "errors": []
         }
         
-        session_file = self.find_latest_session_file()
-        if not session_file:
+        latest = self.find_latest_session_file()
+        if not latest:
             summary["errors"].append("未找到 Codex CLI session 文件")
             summary["status"] = "failed"
             return summary
         
-        token_data = self.parse_session_file(session_file)
+        _, token_data = latest
         if not token_data:
             summary["errors"].append("未找到有效的用量数据，请先在当前账号下使用 codex 发送消息")
             summary["status"] = "failed"
@@ -186,60 +365,51 @@ class CodexUsageChecker:
     
     def format_usage_summary(self, summary: Dict) -> str:
         """格式化使用情况摘要为可读文本"""
-        lines = [
-            f"Codex CLI 用量查询",
-            f"查询时间: {summary['check_time']}",
-            f"状态: {summary['status']}",
-            "-" * 50
-        ]
+        header = (
+            "Codex CLI 用量查询\n"
+            f"查询时间: {summary['check_time']}\n"
+            f"状态: {summary['status']}\n"
+            + "-" * 50
+        )
         
         if summary["status"] == "failed":
-            lines.extend([
-                "❌ 查询失败:",
-                *[f"  - {error}" for error in summary.get("errors", [])],
-                "\n💡 提示:",
-                "  - 请确保已经使用过 Codex CLI",
-                "  - 尝试运行 'codex' 命令并发送一条消息"
-            ])
-            return "\n".join(lines)
+            errors = "".join(f"\n  - {error}" for error in summary.get("errors", []))
+            return _FAILED_SUMMARY_TEMPLATE % (header, errors)
+        
+        lines = [header]
         
         # Token 使用情况
         if summary.get("token_usage"):
             usage = summary["token_usage"]
-            lines.extend([
+            lines.extend((
                 "\n📊 Token 使用情况:",
                 f"  输入 tokens: {usage.get('input_tokens', 0):,}",
                 f"  缓存 tokens: {usage.get('cached_input_tokens', 0):,}",
                 f"  输出 tokens: {usage.get('output_tokens', 0):,}",
                 f"  总计 tokens: {usage.get('total_tokens', 0):,}"
-            ])
+            ))
         
         # 速率限制
         if summary.get("rate_limits"):
-            limits = summary["rate_limits"]
             lines.append("\n⏰ 速率限制:")
             
-            for key, limit in limits.items():
+            now = time.time()
+            today = time.localtime(now)[:3]
+            for limit in summary["rate_limits"].values():
                 if isinstance(limit, dict):
                     used_percent = limit.get("used_percent", 0)
-                    resets_in_seconds = limit.get("resets_in_seconds", 0)
                     window_minutes = limit.get("window_minutes", 0)
-                    
-                    reset_time = datetime.now() + timedelta(seconds=resets_in_seconds)
+                    reset_time = time.localtime(now + limit.get("resets_in_seconds", 0))
                     window_type = "5小时窗口" if window_minutes <= 330 else "周限制"
                     
                     # 格式化重置时间 - 如果是今天就只显示时间，否则显示日期+时间
-                    now = datetime.now()
-                    if reset_time.date() == now.date():
-                        reset_str = reset_time.strftime('%H:%M')
-                    else:
-                        reset_str = reset_time.strftime('%m/%d %H:%M')
+                    reset_format = '%H:%M' if reset_time[:3] == today else '%m/%d %H:%M'
                     
-                    lines.extend([
+                    lines.extend((
                         f"  🔄 {window_type}:",
                         f"    已使用: {used_percent:.1f}%",
-                        f"    重置时间: {reset_str}"
-                    ])
+                        f"    重置时间: {time.strftime(reset_format, reset_time)}"
+                    ))
         
         return "\n".join(lines)
 
@@ -247,18 +417,17 @@ class CodexUsageChecker:
 def extract_email_from_auth(auth_data: Dict) -> Optional[str]:
     """从认证数据中提取邮箱地址"""
     try:
-        import base64
         id_token = auth_data.get("tokens", {}).get("id_token", "")
         if id_token:
-            parts = id_token.split(".")
+            # 只切出 payload 段，不扫描签名部分
+            parts = id_token.split(".", 2)
             if len(parts) >= 2:
-                payload = parts[1]
-                payload += "=" * (4 - len(payload) % 4)
                 try:
-                    decoded = base64.b64decode(payload)
-                    token_data = json.loads(decoded)
+                    # JWT 使用 URL 安全的 base64 且省略填充，多余的 "=" 会被忽略
+                    decoded = base64.urlsafe_b64decode(parts[1].encode() + b"==")
+                    token_data = _loads(decoded)
                     return token_data.get("email")
-                except (ValueError, json.JSONDecodeError):
+                except (ValueError, *_JSON_ERRS):
                     pass
     except (KeyError, TypeError, AttributeError):
         pass
@@ -275,15 +444,11 @@ class OpenAIUsageChecker(CodexUsageChecker):
     
     def get_account_summary(self, email: str = None) -> Dict:
         """获取账号使用情况摘要（兼容性方法）"""
+        # get_usage_summary 每次返回新字典，直接原地改写即可，无需再复制一份
         summary = self.get_usage_summary(email)
-        return {
-            "email": email or "Codex CLI",
-            "check_time": summary["check_time"],
-            "status": summary["status"],
-            "usage_data": summary.get("token_usage", {}),
-            "rate_limits": summary.get("rate_limits", {}),
-            "errors": summary.get("errors", [])
-        }
+        summary["email"] = email or "Codex CLI"
+        summary["usage_data"] = summary.pop("token_usage", {})
+        return summary
 
 
 def extract_access_token_from_auth(auth_data: Dict) -> Optional[str]: